@@ -2,15 +2,20 @@
 ETL Pipeline for OPA Data
 """
 
+import os
+
 from airflow import DAG
-from airflow.operators import BashOperator
 from airflow.operators import PythonOperator
-from airflow.operators import DatumLoadOperator
 from airflow.operators import CleanupOperator
-from airflow.operators import FolderDownloadOperator
+from airflow.operators import CommitDownloadMarkerOperator
+from airflow.operators import FileTransformOperator
+from airflow.operators import MultiFileDownloadOperator
+from airflow.operators import PgCopyCSVOperator
+from airflow.operators import ShortCircuitOperator
+from airflow.operators import StreamingETLOperator
 from airflow.operators import SlackNotificationOperator
-from airflow.operators import CreateStagingFolder, DestroyStagingFolder
 from datetime import datetime, timedelta
+from tempfile import gettempdir
 
 # ============================================================
 # Defaults - these arguments apply to all operators
@@ -26,141 +31,191 @@ default_args = {
     # 'pool': 'backfill',  # TODO: Lookup what pool is
 }
 
-pipeline = DAG('etl_opa_v3', default_args=default_args)  # TODO: Look up how to schedule a DAG
+pipeline = DAG('etl_opa_v3', default_args=default_args,  # TODO: Look up how to schedule a DAG
+    # Leave room for every table's tasks to run at once.
+    concurrency=15,
+)
 
-# ------------------------------------------------------------
-# Extract - copy files to the staging area
+# Each OPA table is extracted from a file on the FTP server, run through a
+# cleanup script, and loaded into a table in the warehouse.
+#
+#   (name, source file, cleanup script, table)
+TABLES = [
+    ('properties',         'br63trf.os13sd',   'phl-properties',         'opa_properties'),
+    ('building_codes',     'br63trf.buildcod', 'phl-building-codes',     'opa_building_codes'),
+    ('street_codes',       'br63trf.stcode',   'phl-street-codes',       'opa_street_codes'),
+    ('off_property',       'br63trf.offpr',    'phl-off-property',       'opa_off_property'),
+    ('assessment_history', 'br63trf.nicrt4wb', 'phl-assessment-history', 'opa_assessment_history'),
+]
+
+# The per-table tasks run in their own pool, with a slot for each table (see
+# scripts/entrypoint.sh), so that the tables are processed side by side
+# instead of queueing behind other DAGs' tasks.
+branch_args = {
+    'pool': 'opa_etl',
+    'priority_weight': 10,
+}
 
-mk_staging = CreateStagingFolder(
-    task_id='staging',
-    dag=pipeline,
-)
+# The staging area for a run. It's the same path on every worker, so that
+# tasks don't have to look it up from another task. Set AIRFLOW_STAGING_ROOT
+# to a folder on storage that all the workers share (the Docker image uses
+# /mnt/airflow-staging); it defaults to the system temp folder.
+STAGING_ROOT = os.environ.get('AIRFLOW_STAGING_ROOT', gettempdir() + '/airflow-staging')
+STAGING = STAGING_ROOT + '/opa/{{ run_id }}'
 
-extract = FolderDownloadOperator(
-    task_id='download_properties',
-    dag=pipeline,
+# The size and modification time of each source file as of its last
+# successful load, so that files that haven't changed on the FTP server
+# aren't downloaded and loaded again. They're kept outside of any one run's
+# staging area, so that they survive the cleanup.
+MARKERS = STAGING_ROOT + '/opa/markers'
 
-    source_type='sftp',
-    source_conn_id='phl-ftp-etl',
-    source_path='/OPA_Property_CD/\'br63trf.os13sd\'',
 
-    dest_path='{{ ti.xcom_pull("staging") }}/br63trf.os13sd',
-)
+def marker_path(name):
+    return MARKERS + '/' + name + '.json'
 
-# ------------------------------------------------------------
-# Transform - run each table through a cleanup script
 
-transform_a = BashOperator(
-    task_id='clean_properties',
-    dag=pipeline,
+def file_changed(name, ti, **context):
+    """
+    Whether the named file was downloaded; the download leaves out the files
+    that haven't changed since they were last loaded.
+    """
+    return name in (ti.xcom_pull(task_ids='download_properties') or {})
 
-    bash_command=
-        'cat {{ ti.xcom_pull("staging") }}/input/\\\'br63trf.os13sd\\\' | '
-        'phl-properties > {{ ti.xcom_pull("staging") }}/properties.csv',
-)
 
-transform_b = BashOperator(
-    task_id='clean_building_codes',
-    dag=pipeline,
+# Stream each file from the FTP server through its cleanup script and into
+# the database in a single task. Set to False to fall back to staging the
+# downloaded and cleaned files on disk between separate tasks.
+STREAM_TABLES = True
 
-    bash_command=
-        'cat {{ ti.xcom_pull("staging") }}/input/\\\'br63trf.buildcod\\\' | '
-        'phl-building-codes > {{ ti.xcom_pull("staging") }}/building_codes.csv',
-)
 
-transform_c = BashOperator(
-    task_id='clean_street_codes',
-    dag=pipeline,
+def make_branch(name, filename, script, table):
+    """
+    Create the tasks that extract, transform, and load a single table, and
+    return them in the order they run.
+    """
+    # ------------------------------------------------------------
+    # Commit - record the source file as loaded once the rest of the
+    # branch has succeeded, so that a failed load is retried next run
 
-    bash_command=
-        'cat {{ ti.xcom_pull("staging") }}/input/\\\'br63trf.stcode\\\' | '
-        'phl-street-codes > {{ ti.xcom_pull("staging") }}/street_codes.csv',
-)
+    commit = CommitDownloadMarkerOperator(
+        task_id='commit_' + name,
+        dag=pipeline,
+        marker_path=marker_path(name),
+        **branch_args
+    )
 
-transform_d = BashOperator(
-    task_id='clean_off_property',
-    dag=pipeline,
+    if STREAM_TABLES:
 
-    bash_command=
-        'cat {{ ti.xcom_pull("staging") }}/input/\\\'br63trf.offpr\\\' | '
-        'phl-off-property > {{ ti.xcom_pull("staging") }}/off_property.csv',
-)
+        # --------------------------------------------------------
+        # Extract, transform, and load the table in one pass
 
-transform_e = BashOperator(
-    task_id='clean_assessment_history',
-    dag=pipeline,
+        etl = StreamingETLOperator(
+            task_id='etl_' + name,
+            dag=pipeline,
 
-    bash_command=
-        'cat {{ ti.xcom_pull("staging") }}/input/\\\'br63trf.nicrt4wb\\\' | '
-        'phl-assessment-history > {{ ti.xcom_pull("staging") }}/assessment_history.csv',
-)
+            source_type='sftp',
+            source_conn_id='phl-ftp-etl',
+            source_path='/OPA_Property_CD/\'' + filename + '\'',
 
+            transform_script=script,
 
-# ------------------------------------------------------------
-# Load - copy tables into on-prem database(s)
+            db_conn_id='phl-warehouse-staging',
+            db_table_name=table,
 
-load_a = DatumLoadOperator(
-    task_id='load_properties',
-    dag=pipeline,
+            skip_unchanged=True,
+            marker_path=marker_path(name),
 
-    csv_path='{{ ti.xcom_pull("staging") }}/properties.csv',
-    db_conn_id='phl-warehouse-staging',
-    db_table_name='opa_properties',
-)
+            **branch_args
+        )
 
-load_b = DatumLoadOperator(
-    task_id='load_building_codes',
-    dag=pipeline,
+        etl >> commit
+        return [etl, commit]
 
-    csv_path='{{ ti.xcom_pull("staging") }}/building_codes.csv',
-    db_conn_id='phl-warehouse-staging',
-    db_table_name='opa_building_codes',
-)
+    # ------------------------------------------------------------
+    # Check - skip the rest of the branch if the file hasn't changed
 
-load_c = DatumLoadOperator(
-    task_id='load_street_codes',
-    dag=pipeline,
+    check = ShortCircuitOperator(
+        task_id='check_' + name,
+        dag=pipeline,
 
-    csv_path='{{ ti.xcom_pull("staging") }}/street_codes.csv',
-    db_conn_id='phl-warehouse-staging',
-    db_table_name='opa_street_codes',
-)
+        python_callable=file_changed,
+        op_kwargs={'name': name},
+        provide_context=True,
 
-load_d = DatumLoadOperator(
-    task_id='load_off_property',
-    dag=pipeline,
+        **branch_args
+    )
 
-    csv_path='{{ ti.xcom_pull("staging") }}/off_property.csv',
-    db_conn_id='phl-warehouse-staging',
-    db_table_name='opa_off_property',
-)
+    # ------------------------------------------------------------
+    # Transform - run the table through a cleanup script
 
-load_e = DatumLoadOperator(
-    task_id='load_assessment_history',
-    dag=pipeline,
+    transform = FileTransformOperator(
+        task_id='clean_' + name,
+        dag=pipeline,
 
-    csv_path='{{ ti.xcom_pull("staging") }}/assessment_history.csv',
-    db_conn_id='phl-warehouse-staging',
-    db_table_name='opa_assessment_history',
-)
+        source_type='local',
+        source_path=STAGING + '/input/' + filename,
 
-# ------------------------------------------------------------
-# Postscript - clean up the staging area
+        dest_type='local',
+        dest_path=STAGING + '/' + name + '.csv',
 
-cleanup = CleanupOperator(
-    task_id='cleanup_staging',
-    dag=pipeline,
-    paths='{{ ti.xcom_pull("staging") }}',
-)
+        transform_script=script,
 
+        **branch_args
+    )
 
-# ============================================================
-# Configure the pipeline's dag
+    # ------------------------------------------------------------
+    # Load - copy the table into on-prem database(s)
+
+    load = PgCopyCSVOperator(
+        task_id='load_' + name,
+        dag=pipeline,
+
+        csv_path=STAGING + '/' + name + '.csv',
+        db_conn_id='phl-warehouse-staging',
+        db_table_name=table,
+
+        **branch_args
+    )
+
+    check >> transform >> load >> commit
+    return [check, transform, load, commit]
+
+
+branches = [make_branch(*config) for config in TABLES]
+
+if not STREAM_TABLES:
+
+    # ------------------------------------------------------------
+    # Extract - copy files to the staging area
+
+    extract = MultiFileDownloadOperator(
+        task_id='download_properties',
+        dag=pipeline,
+
+        source_type='sftp',
+        source_conn_id='phl-ftp-etl',
+        transfers={
+            name: ('/OPA_Property_CD/\'' + filename + '\'',
+                   STAGING + '/input/' + filename)
+            for name, filename, _, _ in TABLES
+        },
+
+        skip_unchanged=True,
+        marker_paths={name: marker_path(name) for name, _, _, _ in TABLES},
+    )
+
+    # ------------------------------------------------------------
+    # Postscript - clean up the staging area
+
+    cleanup = CleanupOperator(
+        task_id='cleanup_staging',
+        dag=pipeline,
+        paths=STAGING,
 
-mk_staging >> extract
+        # Clean up whether or not the tables were loaded (or skipped)
+        trigger_rule='all_done',
+    )
 
-extract >> transform_a >> load_a >> cleanup
-extract >> transform_b >> load_b >> cleanup
-extract >> transform_c >> load_c >> cleanup
-extract >> transform_d >> load_d >> cleanup
-extract >> transform_e >> load_e >> cleanup
+    for branch in branches:
+        extract >> branch[0]
+        branch[-1] >> cleanup
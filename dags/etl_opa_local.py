@@ -9,8 +9,9 @@ from airflow.operators import DatumLoadOperator
 from airflow.operators import CleanupOperator
 from airflow.operators import FolderDownloadOperator
 from airflow.operators import SlackNotificationOperator
-from airflow.operators import CreateStagingFolder, DestroyStagingFolder
+from airflow.operators import DestroyStagingFolder
 from datetime import datetime, timedelta
+from tempfile import gettempdir
 
 # ============================================================
 # Defaults - these arguments apply to all operators
@@ -30,14 +31,13 @@ db_conn_id = 'phl-warehouse-staging'
 
 pipeline = DAG('etl_opa_local_v2', default_args=default_args)
 
+# The staging area for a run. It's known up front, so tasks don't have to
+# look it up from another task when their templates are rendered.
+STAGING = gettempdir() + '/airflow-staging/opa_local/{{ run_id }}'
+
 # ------------------------------------------------------------
 # Extract - copy files to the staging area
 
-mk_staging = CreateStagingFolder(
-    task_id='staging',
-    dag=pipeline,
-)
-
 extract = FolderDownloadOperator(
     task_id='download_properties',
     dag=pipeline,
@@ -45,7 +45,7 @@ extract = FolderDownloadOperator(
     source_type='local',
     source_path='/home/mjumbewu/Programming/phila/property-assessments-data-pipeline/input',
 
-    dest_path='{{ ti.xcom_pull("staging") }}/input',
+    dest_path=STAGING + '/input',
 )
 
 # ------------------------------------------------------------
@@ -56,8 +56,8 @@ transform_a = BashOperator(
     dag=pipeline,
 
     bash_command=
-        'cat {{ ti.xcom_pull("staging") }}/input/\\\'br63trf.os13sd\\\' | '
-        'phl-properties > {{ ti.xcom_pull("staging") }}/properties.csv',
+        'cat ' + STAGING + '/input/\\\'br63trf.os13sd\\\' | '
+        'phl-properties > ' + STAGING + '/properties.csv',
 )
 
 transform_b = BashOperator(
@@ -65,8 +65,8 @@ transform_b = BashOperator(
     dag=pipeline,
 
     bash_command=
-        'cat {{ ti.xcom_pull("staging") }}/input/\\\'br63trf.buildcod\\\' | '
-        'phl-building-codes > {{ ti.xcom_pull("staging") }}/building_codes.csv',
+        'cat ' + STAGING + '/input/\\\'br63trf.buildcod\\\' | '
+        'phl-building-codes > ' + STAGING + '/building_codes.csv',
 )
 
 transform_c = BashOperator(
@@ -74,8 +74,8 @@ transform_c = BashOperator(
     dag=pipeline,
 
     bash_command=
-        'cat {{ ti.xcom_pull("staging") }}/input/\\\'br63trf.stcode\\\' | '
-        'phl-street-codes > {{ ti.xcom_pull("staging") }}/street_codes.csv',
+        'cat ' + STAGING + '/input/\\\'br63trf.stcode\\\' | '
+        'phl-street-codes > ' + STAGING + '/street_codes.csv',
 )
 
 transform_d = BashOperator(
@@ -83,8 +83,8 @@ transform_d = BashOperator(
     dag=pipeline,
 
     bash_command=
-        'cat {{ ti.xcom_pull("staging") }}/input/\\\'br63trf.offpr\\\' | '
-        'phl-off-property > {{ ti.xcom_pull("staging") }}/off_property.csv',
+        'cat ' + STAGING + '/input/\\\'br63trf.offpr\\\' | '
+        'phl-off-property > ' + STAGING + '/off_property.csv',
 )
 
 transform_e = BashOperator(
@@ -92,8 +92,8 @@ transform_e = BashOperator(
     dag=pipeline,
 
     bash_command=
-        'cat {{ ti.xcom_pull("staging") }}/input/\\\'br63trf.nicrt4wb\\\' | '
-        'phl-assessment-history > {{ ti.xcom_pull("staging") }}/assessment_history.csv',
+        'cat ' + STAGING + '/input/\\\'br63trf.nicrt4wb\\\' | '
+        'phl-assessment-history > ' + STAGING + '/assessment_history.csv',
 )
 
 
@@ -104,7 +104,7 @@ load_a = DatumLoadOperator(
     task_id='load_properties',
     dag=pipeline,
 
-    csv_path='{{ ti.xcom_pull("staging") }}/properties.csv',
+    csv_path=STAGING + '/properties.csv',
     db_conn_id=db_conn_id,
     db_table_name='opa_properties',
 )
@@ -113,7 +113,7 @@ load_b = DatumLoadOperator(
     task_id='load_building_codes',
     dag=pipeline,
 
-    csv_path='{{ ti.xcom_pull("staging") }}/building_codes.csv',
+    csv_path=STAGING + '/building_codes.csv',
     db_conn_id=db_conn_id,
     db_table_name='opa_building_codes',
 )
@@ -122,7 +122,7 @@ load_c = DatumLoadOperator(
     task_id='load_street_codes',
     dag=pipeline,
 
-    csv_path='{{ ti.xcom_pull("staging") }}/street_codes.csv',
+    csv_path=STAGING + '/street_codes.csv',
     db_conn_id=db_conn_id,
     db_table_name='opa_street_codes',
 )
@@ -131,7 +131,7 @@ load_d = DatumLoadOperator(
     task_id='load_off_property',
     dag=pipeline,
 
-    csv_path='{{ ti.xcom_pull("staging") }}/off_property.csv',
+    csv_path=STAGING + '/off_property.csv',
     db_conn_id=db_conn_id,
     db_table_name='opa_off_property',
 )
@@ -140,7 +140,7 @@ load_e = DatumLoadOperator(
     task_id='load_assessment_history',
     dag=pipeline,
 
-    csv_path='{{ ti.xcom_pull("staging") }}/assessment_history.csv',
+    csv_path=STAGING + '/assessment_history.csv',
     db_conn_id=db_conn_id,
     db_table_name='opa_assessment_history',
 )
@@ -151,15 +151,13 @@ load_e = DatumLoadOperator(
 cleanup = DestroyStagingFolder(
     task_id='cleanup_staging',
     dag=pipeline,
-    dir='{{ ti.xcom_pull("staging") }}',
+    dir=STAGING,
 )
 
 
 # ============================================================
 # Configure the pipeline's dag
 
-mk_staging >> extract
-
 extract >> transform_a >> load_a >> cleanup
 extract >> transform_b >> load_b >> cleanup
 extract >> transform_c >> load_c >> cleanup
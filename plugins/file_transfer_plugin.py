@@ -1,13 +1,18 @@
+import csv
 import errno
+import json
 import logging
 import pysftp
 import os
+import signal
 import subprocess
+import threading
+import time
 
 from airflow.plugins_manager import AirflowPlugin
 
 from airflow.contrib.hooks.ftp_hook import FTPHook
-from airflow.exceptions import AirflowException
+from airflow.exceptions import AirflowException, AirflowSkipException
 from airflow.hooks import BaseHook
 from airflow.hooks.S3_hook import S3Hook
 from airflow.models import BaseOperator
@@ -15,12 +20,38 @@ from airflow.operators.sensors import BaseSensorOperator
 from airflow.utils.decorators import apply_defaults
 from past.builtins import basestring
 
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from io import BytesIO
 from os.path import exists
 from os.path import isdir
-from shutil import copyfile, copytree, rmtree
-from tempfile import mkstemp, NamedTemporaryFile
+from shutil import copyfile, copyfileobj, copytree, rmtree
+from tempfile import mkdtemp, mkstemp, NamedTemporaryFile, TemporaryFile
+
+
+# The buffer size to use when streaming data between files, processes and
+# connections.
+COPY_BUFSIZE = 1024 * 1024
+
+# How often (in seconds) to send keepalive packets on pooled SFTP connections.
+SFTP_KEEPALIVE_INTERVAL = 30
+
+# How long (in seconds) a pooled SFTP connection may sit idle before it's
+# closed instead of reused.
+SFTP_MAX_IDLE_TIME = 5 * 60
+
+# How long (in seconds) to reuse an SFTP folder listing when checking whether
+# files exist.
+SFTP_LISTING_TTL = 5
+
+# SSH channel window and packet sizes for SFTP connections.
+SFTP_WINDOW_SIZE = 4 * 1024 * 1024
+SFTP_MAX_PACKET_SIZE = 512 * 1024
+
+# S3 objects larger than the chunk size are downloaded in byte-range parts of
+# that size, up to S3_MAX_CONCURRENCY parts at a time.
+S3_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+S3_MAX_CONCURRENCY = 10
 
 
 try:
@@ -46,6 +77,322 @@ def makedirs(path, exist_ok=False):
     return False
 
 
+def open_preallocated(path, size):
+    """
+    Open a local file for writing in binary mode, with `size` bytes of disk
+    allocated for it up front so that the file system doesn't have to grow it
+    piece by piece as it's written.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    if size and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError as e:
+            # Not every file system supports preallocation.
+            logging.info('Could not preallocate space for {}: {}'.format(path, e))
+    return os.fdopen(fd, 'wb', COPY_BUFSIZE)
+
+
+def is_os_file(fileob):
+    """
+    Check whether a file-like object is backed by an OS-level file descriptor,
+    and so can be handed directly to a subprocess.
+    """
+    try:
+        fileob.fileno()
+    except (AttributeError, OSError, ValueError):
+        return False
+    return True
+
+
+class ScriptInputClosed (BrokenPipeError):
+    """
+    Raised when a script closes its stdin before all of the data has been
+    written to it. Unlike other broken pipes, it says nothing about the
+    health of the connection the data was coming from.
+    """
+
+
+class ScriptInput (object):
+    """
+    Wraps a script's stdin, so that writes after the script has stopped
+    reading raise `ScriptInputClosed`.
+    """
+    def __init__(self, pipe):
+        self.pipe = pipe
+
+    def write(self, data):
+        try:
+            return self.pipe.write(data)
+        except BrokenPipeError as e:
+            raise ScriptInputClosed(*e.args)
+
+    def __getattr__(self, name):
+        return getattr(self.pipe, name)
+
+
+def pipe_through(script_args, feed, drain):
+    """
+    Run a script, streaming data through it without staging it on disk. The
+    `feed` callable is given the script's stdin and run on a background
+    thread; the `drain` callable is given the script's stdout and run on the
+    current thread. Returns the result of `drain`.
+    """
+    feed_errors = []
+    drain_error = None
+
+    with TemporaryFile() as stderr:
+        logging.info('Running the script command: ' + ' '.join(script_args))
+        proc = subprocess.Popen(script_args,
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=stderr,
+                                bufsize=COPY_BUFSIZE)
+
+        def feed_stdin():
+            try:
+                feed(ScriptInput(proc.stdin))
+            except Exception as e:
+                feed_errors.append(e)
+            finally:
+                try:
+                    proc.stdin.close()
+                except (IOError, OSError):
+                    pass
+
+        feeder = threading.Thread(target=feed_stdin)
+        feeder.daemon = True
+        feeder.start()
+
+        try:
+            result = drain(proc.stdout)
+        except BaseException as e:
+            drain_error = e
+            proc.kill()
+        finally:
+            # Close stdout first, so that anything still writing to it (like a
+            # child process of a script we killed) gets a broken pipe instead
+            # of blocking, and stops reading from the feeder in turn.
+            proc.stdout.close()
+            feeder.join()
+            returncode = proc.wait()
+
+        # A script that fails part way through stops reading its input (and
+        # writing its output), so the errors on either side of it are only
+        # symptoms; report the script's own error in preference to them. If
+        # we killed the script ourselves, it's the drain's error that counts.
+        killed = drain_error is not None and returncode == -signal.SIGKILL
+        if returncode != 0 and not killed:
+            stderr.seek(0)
+            raise AirflowException("Script failed with exit status {}: {}".format(
+                returncode, stderr.read().decode('utf-8', 'replace')))
+        if drain_error is not None:
+            raise drain_error
+        if feed_errors:
+            raise feed_errors[0]
+
+    return result
+
+
+def copy_csv_into_table(cursor, table_name, csvfile):
+    """
+    Stream a CSV file into a table using Postgres' COPY. The column names are
+    taken from the CSV's header row.
+    """
+    header = csvfile.readline()
+    if not header:
+        raise AirflowException('No CSV header found to load into {}'.format(table_name))
+    if isinstance(header, bytes):
+        header = header.decode('utf-8')
+    columns = next(csv.reader([header]))
+
+    # The header comes from the file, so quote each name as an identifier
+    # rather than trusting it to be valid (or safe) SQL.
+    column_list = ', '.join(quote_identifier(column) for column in columns)
+
+    logging.info("Copying data into the {} table".format(table_name))
+    cursor.copy_expert(
+        'COPY {} ({}) FROM STDIN WITH CSV'.format(table_name, column_list),
+        csvfile, size=COPY_BUFSIZE)
+
+
+def quote_identifier(name):
+    """
+    Quote a name for use as a Postgres identifier. Unquoted identifiers are
+    folded to lower case by Postgres, so the name is lower-cased as well to
+    match the columns that the tables were created with.
+    """
+    return '"{}"'.format(name.strip().lower().replace('"', '""'))
+
+
+@contextmanager
+def table_load(db_conn_id, table_name, truncate=True):
+    """
+    Open a Postgres transaction for (re)loading a table, and yield a cursor to
+    load with. The table is truncated first if `truncate` is set, and the
+    transaction is only committed if the block succeeds.
+    """
+    from airflow.hooks.postgres_hook import PostgresHook
+
+    logging.info("Connecting to the database {}".format(db_conn_id))
+    db_conn = PostgresHook(postgres_conn_id=db_conn_id).get_conn()
+    try:
+        with db_conn.cursor() as cursor:
+            # Nothing else depends on the load being durable the moment it
+            # commits, so don't wait on the WAL flush.
+            cursor.execute('SET LOCAL synchronous_commit TO OFF')
+
+            if truncate:
+                logging.info("Truncating the {} table".format(table_name))
+                cursor.execute('TRUNCATE {}'.format(table_name))
+
+            yield cursor
+        db_conn.commit()
+    except:
+        db_conn.rollback()
+        raise
+    finally:
+        db_conn.close()
+
+
+def pending_marker_path(marker_path):
+    return marker_path + '.pending'
+
+
+def read_marker(marker_path):
+    try:
+        with open(marker_path) as marker:
+            return json.load(marker)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_marker(marker_path, signature):
+    # Write to a temporary file and move it into place, so that a failure
+    # part way through never leaves a half-written marker behind.
+    marker_dir = os.path.dirname(marker_path)
+    if marker_dir:
+        makedirs(marker_dir, exist_ok=True)
+    fd, tmp_path = mkstemp(dir=marker_dir or None)
+    with os.fdopen(fd, 'w') as marker:
+        json.dump(signature, marker)
+    os.replace(tmp_path, marker_path)
+
+
+def source_signature(hook, path):
+    """
+    Get the size and modification time of a source file, to compare with the
+    marker recorded when it was last processed.
+    """
+    source_stat = hook.stat(path)
+    return [source_stat.st_size, source_stat.st_mtime]
+
+
+def stage_marker(marker_path, signature):
+    """
+    Record a source file's signature as pending. It only replaces the marker
+    once a `CommitDownloadMarkerOperator` at the end of the branch runs, so
+    that a failed transform or load is retried on the next run instead of
+    being skipped.
+    """
+    pending_path = pending_marker_path(marker_path)
+    write_marker(pending_path, signature)
+    logging.info("Staged the file's size and modification time in {}"
+                 .format(pending_path))
+
+
+class SFTPConnectionPool (object):
+    """
+    Keeps idle SFTP connections around, keyed by connection id, so that
+    several transfers against the same server -- including later tasks run by
+    the same worker process -- don't each pay for a fresh SSH handshake.
+    Connections are built lazily by the factory passed to `acquire`. The most
+    recently used connection is handed out first, and at most `max_idle` idle
+    connections are kept per connection id; any more are closed.
+
+    Connections that sit idle for longer than `max_idle_time` seconds are
+    closed rather than reused, so that e.g. a sensor with a long poke interval
+    doesn't hold a session open on the server between pokes.
+    """
+    def __init__(self, max_idle=4, max_idle_time=SFTP_MAX_IDLE_TIME):
+        self.max_idle = max_idle
+        self.max_idle_time = max_idle_time
+
+        # Idle connections, as {conn_id: [(time released, conn), ...]}, with
+        # the most recently released connection last.
+        self._idle = defaultdict(list)
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def acquire(self, conn_id, factory):
+        self.close_stale()
+
+        dead = []
+        conn = None
+        with self._lock:
+            idle = self._idle[conn_id]
+            while idle and conn is None:
+                _, candidate = idle.pop()
+
+                # The server may have dropped the connection while it sat idle.
+                transport = candidate._transport
+                if transport is not None and transport.is_active():
+                    conn = candidate
+                else:
+                    dead.append(candidate)
+
+        for candidate in dead:
+            candidate.close()
+        return conn if conn is not None else factory()
+
+    def release(self, conn_id, conn):
+        overflow = []
+        with self._lock:
+            idle = self._idle[conn_id]
+            idle.append((time.time(), conn))
+            while len(idle) > self.max_idle:
+                _, oldest = idle.pop(0)
+                overflow.append(oldest)
+            self._start_reaper()
+
+        for oldest in overflow:
+            oldest.close()
+
+    def close_stale(self):
+        """
+        Close any connections that have been idle for longer than
+        `max_idle_time`.
+        """
+        cutoff = time.time() - self.max_idle_time
+        stale = []
+        with self._lock:
+            for conn_id, idle in self._idle.items():
+                stale.extend(conn for released_at, conn in idle if released_at < cutoff)
+                idle[:] = [(released_at, conn) for released_at, conn in idle
+                           if released_at >= cutoff]
+
+        for conn in stale:
+            logging.info('Closing an SFTP connection that has been idle too long')
+            conn.close()
+
+    def _start_reaper(self):
+        # Called with the lock held. Idle connections are also closed in the
+        # background, so they don't stay open while nothing uses the pool.
+        if self._reaper is not None:
+            return
+
+        def reap():
+            while True:
+                time.sleep(self.max_idle_time / 2.0)
+                self.close_stale()
+
+        self._reaper = threading.Thread(target=reap)
+        self._reaper.daemon = True
+        self._reaper.start()
+
+sftp_pool = SFTPConnectionPool()
+
+
 class CommonFileHook (BaseHook):
     """
     Base class for hooks that implement the common file interface. Provides
@@ -113,6 +460,13 @@ class CommonFileHook (BaseHook):
     def folder_exists(self, remotepath):
         raise NotImplementedError
 
+    def stat(self, remotepath):
+        """
+        Return an object with (at least) the `st_size` and `st_mtime` of a
+        remote file.
+        """
+        raise NotImplementedError
+
 # ---------------------------------------------------------
 
 class CommonFSHook (CommonFileHook):
@@ -130,11 +484,18 @@ class CommonFSHook (CommonFileHook):
             else: raise FileExistsError(localpath)
         copytree(remotepath, localpath)
 
+    def retrieve_file(self, remotepath, fileob):
+        with open(remotepath, 'rb') as source:
+            copyfileobj(source, fileob, COPY_BUFSIZE)
+
     def upload(self, localpath, remotepath, replace=True):
         if not replace and exists(remotepath):
             raise FileExistsError(remotepath)
         copyfile(localpath, remotepath)
 
+    def stat(self, remotepath):
+        return os.stat(remotepath)
+
     def delete(self, path, is_dir=None):
         if is_dir is None:
             is_dir = isdir(path)
@@ -148,7 +509,8 @@ class CommonFSHook (CommonFileHook):
 
     @contextmanager
     def open(self, remotepath, mode='rb'):
-        return open(remotepath, mode)
+        with open(remotepath, mode) as fileob:
+            yield fileob
 
 # ---------------------------------------------------------
 
@@ -190,19 +552,28 @@ class CommonFTPHookMixin (CommonFileHook):
         elif mode_params['can_write'] and not mode_params['replace']:
             raise NotImplementedError('Cannot append to a file over FTP.')
         elif mode_params['can_read']:
-            return self._open_for_read(remotepath, **mode_params)
+            with self._open_for_read(remotepath, **mode_params) as fileob:
+                yield fileob
         elif mode_params['can_write']:
-            return self._open_for_write(remotepath, **mode_params)
+            with self._open_for_write(remotepath, **mode_params) as fileob:
+                yield fileob
 
+    # The file is spooled through a temporary file on disk rather than held in
+    # memory, so that opening a large file doesn't need memory to match.
+
+    @contextmanager
     def _open_for_read(self, remotepath, **mode_params):
-        fileob = BytesIO()
-        self.retrieve_file(path, fileob)
-        yield fileob
+        with TemporaryFile() as fileob:
+            self.retrieve_file(remotepath, fileob)
+            fileob.seek(0)
+            yield fileob
 
+    @contextmanager
     def _open_for_write(self, remotepath, **mode_params):
-        fileob = BytesIO()
-        self.store_file(remotepath, fileob)
-        yield fileob
+        with TemporaryFile() as fileob:
+            yield fileob
+            fileob.seek(0)
+            self.store_file(remotepath, fileob)
 
 class PySFTPHook (FTPHook):
     """
@@ -212,64 +583,189 @@ class PySFTPHook (FTPHook):
     ends up reimplementing many methods.
     """
 
+    def __init__(self, *args, **kwargs):
+        FTPHook.__init__(self, *args, **kwargs)
+
+        # Recent folder listings, as {folder: (time listed, [attrs, ...])}
+        self._listings = {}
+
     def get_conn(self):
         """
-        Returns a PySFTP connection object
+        Returns a PySFTP connection object, reusing an idle connection from
+        the pool if there is one.
         """
         if self.conn is None:
-            logging.info("Using Connection with ID {}".format(self.ftp_conn_id))
-            params = self.get_connection(self.ftp_conn_id)
-            logging.info('Establishing secure connection to {}'.format(params.host))
-            self.conn = pysftp.Connection   (
-                params.host, username=params.login, password=params.password
-            )
+            self.conn = sftp_pool.acquire(self.ftp_conn_id, self._connect)
         return self.conn
 
-    def retrieve_file(self, remote_full_path, local_full_path_or_buffer):
-        conn = self.get_conn()
+    def release_conn(self):
+        """
+        Return the connection to the pool so that it can be reused.
+        """
+        if self.conn is not None:
+            sftp_pool.release(self.ftp_conn_id, self.conn)
+            self.conn = None
 
-        is_path = isinstance(local_full_path_or_buffer, basestring)
+    def close_conn(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
 
-        if is_path:
-            output_handle = open(local_full_path_or_buffer, 'wb')
+    @contextmanager
+    def pooled_conn(self):
+        """
+        Borrow a connection from the pool for the duration of a block. The
+        connection is discarded instead of returned if the block fails,
+        unless it failed because a script stopped reading what it was sent.
+        """
+        conn = self.get_conn()
+        try:
+            yield conn
+        except ScriptInputClosed:
+            # The script we were feeding went away; the connection is fine.
+            self.release_conn()
+            raise
+        except:
+            self.close_conn()
+            raise
         else:
-            output_handle = local_full_path_or_buffer
+            self.release_conn()
 
-        logging.info('Retrieving file from FTP: {}'.format(remote_full_path))
-        conn.getfo(remote_full_path, output_handle)
-        logging.info('Finished retrieving file from FTP: {}'.format(
-            remote_full_path))
+    def _connect(self):
+        logging.info("Using Connection with ID {}".format(self.ftp_conn_id))
+        params = self.get_connection(self.ftp_conn_id)
+        logging.info('Establishing secure connection to {}'.format(params.host))
 
-        if is_path:
-            output_handle.close()
+        # The files we pull are mostly plain text, so compress the transport
+        # unless the connection's extras say otherwise (`"compression": false`).
+        cnopts = pysftp.CnOpts()
+        cnopts.compression = params.extra_dejson.get('compression', True)
 
-    def retrieve_folder(self, remote_full_path, local_full_path):
-        conn = self.get_conn()
+        conn = pysftp.Connection(
+            params.host, username=params.login, password=params.password,
+            cnopts=cnopts
+        )
+
+        transport = conn._transport
+
+        # Keep the connection from being dropped while it's idle in the pool.
+        transport.set_keepalive(SFTP_KEEPALIVE_INTERVAL)
+
+        # A single transfer can't go faster than window size / round trip
+        # time, so open up the SSH channel window. (The TCP buffers under it
+        # are left to the kernel's autotuning.) pysftp doesn't open its SFTP
+        # channel until the connection is first used, so the channel picks up
+        # these window settings.
+        transport.default_window_size = SFTP_WINDOW_SIZE
+        transport.default_max_packet_size = SFTP_MAX_PACKET_SIZE
+        return conn
 
-        logging.info('Retrieving files in folder from FTP: {}'.format(remote_full_path))
-        conn.get_d(remote_full_path, local_full_path)
-        logging.info('Finished retrieving folder from FTP: {}'.format(
-            remote_full_path))
+    def retrieve_file(self, remote_full_path, local_full_path_or_buffer):
+        is_path = isinstance(local_full_path_or_buffer, basestring)
+
+        with self.pooled_conn() as conn:
+            if is_path:
+                size = conn.stat(remote_full_path).st_size
+                output_handle = open_preallocated(local_full_path_or_buffer, size)
+            else:
+                output_handle = local_full_path_or_buffer
+
+            try:
+                logging.info('Retrieving file from FTP: {}'.format(remote_full_path))
+                conn.getfo(remote_full_path, output_handle)
+                logging.info('Finished retrieving file from FTP: {}'.format(
+                    remote_full_path))
+
+                # Trim any preallocated space we didn't use, in case the file
+                # changed on the server since we checked its size.
+                if is_path:
+                    output_handle.truncate()
+            finally:
+                if is_path:
+                    output_handle.close()
+
+    def retrieve_folder(self, remote_full_path, local_full_path):
+        with self.pooled_conn() as conn:
+            logging.info('Retrieving files in folder from FTP: {}'.format(remote_full_path))
+            conn.get_d(remote_full_path, local_full_path)
+            logging.info('Finished retrieving folder from FTP: {}'.format(
+                remote_full_path))
 
     def _match_basename(self, dirname, basepattern, modefilter=None):
         import stat
         from fnmatch import fnmatch
 
-        conn = self.get_conn()
         modefilter = modefilter or (lambda mode: True)
 
-        logging.info('Changing into folder {} to look for pattern {}'.format(dirname, basepattern))
-        with conn.cd(dirname):
-            basenames = [attrs.filename for attrs in conn.listdir_attr()
-                         if modefilter(attrs.st_mode) and fnmatch(attrs.filename, basepattern)]
+        # Without any wildcards there's at most one match, so just stat it
+        # instead of listing the whole folder.
+        if not any(c in basepattern for c in '*?['):
+            remote_full_path = os.path.join(dirname, basepattern)
+            logging.info('Checking for {}'.format(remote_full_path))
+            with self.pooled_conn() as conn:
+                try:
+                    attrs = conn.stat(remote_full_path)
+                except IOError:
+                    attrs = None
+            basenames = [basepattern] if attrs and modefilter(attrs.st_mode) else []
+            logging.info('Found the following files: {}'.format(basenames))
+            return basenames
+
+        logging.info('Looking in folder {} for pattern {}'.format(dirname, basepattern))
+        basenames = [attrs.filename for attrs in self._list_folder(dirname)
+                     if modefilter(attrs.st_mode) and fnmatch(attrs.filename, basepattern)]
         logging.info('Found the following files: {}'.format(basenames))
         return basenames
 
+    def _list_folder(self, dirname):
+        """
+        Get the attributes of everything in a folder. A listing fetched within
+        the last SFTP_LISTING_TTL seconds is reused, so that bursts of
+        existence checks don't each enumerate the folder on the server.
+        """
+        now = time.time()
+        listed_at, listing = self._listings.get(dirname, (None, None))
+        if listed_at is not None and now - listed_at < SFTP_LISTING_TTL:
+            return listing
+
+        logging.info('Changing into folder {} to list its contents'.format(dirname))
+        with self.pooled_conn() as conn:
+            with conn.cd(dirname):
+                listing = conn.listdir_attr()
+        self._listings[dirname] = (now, listing)
+        return listing
+
+    def _forget_listing(self, remote_full_path):
+        self._listings.pop(os.path.dirname(remote_full_path), None)
+
+    def store_file(self, remote_full_path, local_full_path_or_buffer):
+        is_path = isinstance(local_full_path_or_buffer, basestring)
+
+        with self.pooled_conn() as conn:
+            logging.info('Storing file to FTP: {}'.format(remote_full_path))
+            if is_path:
+                conn.put(local_full_path_or_buffer, remote_full_path)
+            else:
+                conn.putfo(local_full_path_or_buffer, remote_full_path)
+            logging.info('Finished storing file to FTP: {}'.format(
+                remote_full_path))
+        self._forget_listing(remote_full_path)
+
+    def delete_file(self, path):
+        with self.pooled_conn() as conn:
+            logging.info('Deleting file from FTP: {}'.format(path))
+            conn.remove(path)
+        self._forget_listing(path)
+
+    def stat(self, remote_full_path):
+        with self.pooled_conn() as conn:
+            return conn.stat(remote_full_path)
+
     def file_exists(self, remote_full_path):
         """
         Check if a file exists. A pySFTP connection has an `isfile` method, but
-        we search a directory listing instead, so that we can support wildcard
-        matches.
+        we search a directory listing instead when the name has wildcards, so
+        that we can support wildcard matches.
         """
         from stat import S_ISREG
         pathhead, pathtail = os.path.split(remote_full_path)
@@ -279,8 +775,8 @@ class PySFTPHook (FTPHook):
     def folder_exists(self, remote_full_path):
         """
         Check if a folder exists. A pySFTP connection has an `isdir` method, but
-        we search a directory listing instead, so that we can support wildcard
-        matches.
+        we search a directory listing instead when the name has wildcards, so
+        that we can support wildcard matches.
         """
         from stat import S_ISDIR
         pathhead, pathtail = os.path.split(remote_full_path.rstrip('/'))
@@ -301,22 +797,101 @@ class CommonS3Hook (S3Hook, CommonFileHook):
     def __init__(self, conn_id):
         S3Hook.__init__(self, s3_conn_id=conn_id)
 
+    def get_transfer_client(self):
+        """
+        Returns a boto3 S3 client and a transfer config, for downloading
+        large objects in concurrent byte-range parts.
+        """
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+
+        # Find credentials the same way S3Hook does: keys in the connection's
+        # extras, then keys from a config file, then boto's own lookup (with
+        # an optional profile).
+        extras = self.get_connection(self.s3_conn_id).extra_dejson
+        access_key = secret_key = profile = None
+        if 'aws_secret_access_key' in extras:
+            access_key = extras['aws_access_key_id']
+            secret_key = extras['aws_secret_access_key']
+        elif 's3_config_file' in extras:
+            from airflow.hooks.S3_hook import _parse_s3_config
+            access_key, secret_key = _parse_s3_config(
+                extras['s3_config_file'],
+                extras.get('s3_config_format'),
+                extras.get('profile'))
+        else:
+            profile = extras.get('profile')
+
+        session = boto3.session.Session(
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+            profile_name=profile)
+        client = session.client('s3')
+        config = TransferConfig(
+            multipart_threshold=S3_MULTIPART_CHUNKSIZE,
+            multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+            max_concurrency=S3_MAX_CONCURRENCY,
+            use_threads=True)
+        return client, config
+
+    def download(self, remotepath, localpath, replace=True):
+        if not replace and exists(localpath):
+            raise FileExistsError(localpath)
+        dirname = os.path.dirname(localpath)
+        logging.info('Creating the folder {}, if it does not exist'.format(dirname))
+        if makedirs(dirname, exist_ok=True):
+            logging.info('Created!')
+        else:
+            logging.info('Already existed.')
+
+        bucket_name, key = self.parse_s3_url(remotepath)
+        client, config = self.get_transfer_client()
+        client.download_file(bucket_name, key, localpath, Config=config)
+
     @contextmanager
     def open(self, remotepath, mode='r'):
-        s3_obj = self.get_key(path)
+        bucket_name, key = self.parse_s3_url(remotepath)
+        client, config = self.get_transfer_client()
         with NamedTemporaryFile() as fileob:
-            s3_obj.get_contents_to_file(fileob)
+            client.download_fileobj(bucket_name, key, fileob, Config=config)
+            fileob.seek(0)
             yield fileob
 
 
 # =========================================================
 # Operators
 
-class FileDownloadOperator(BaseOperator):
+class SourceHookMixin (object):
+    """
+    Builds the hook for an operator's source connection once and reuses it,
+    so that e.g. a sensor doesn't reconnect on every poke.
+    """
+    @property
+    def source_hook(self):
+        if getattr(self, '_source_hook', None) is None:
+            self._source_hook = self.SourceHook(self.source_conn_id)
+        return self._source_hook
+
+class FileDownloadOperator(SourceHookMixin, BaseOperator):
     """
     Downloads a file from a connection.
+
+    :param skip_unchanged: Whether to skip the download (and, by default, the
+                           tasks downstream of it) when the source file has
+                           the same size and modification time as when it was
+                           last processed. Only supported for sources whose
+                           hook implements `stat`.
+    :type skip_unchanged: bool
+    :param marker_path: Where the size and modification time of the last
+                        processed file are recorded. Required when
+                        `skip_unchanged` is set, and it should be somewhere
+                        that outlives a single run. The download only leaves
+                        a pending marker next to it; put a
+                        `CommitDownloadMarkerOperator` at the end of the
+                        branch to record the file once it has been loaded.
+    :type marker_path: string
     """
-    template_fields = ('source_path','dest_path',)
+    template_fields = ('source_path','dest_path','marker_path',)
     template_ext = ()
     ui_color = '#ffcc44'
 
@@ -326,6 +901,8 @@ class FileDownloadOperator(BaseOperator):
                  source_path,
                  source_conn_id=None,
                  dest_path=None,
+                 skip_unchanged=False,
+                 marker_path=None,
                  *args, **kwargs):
         super(FileDownloadOperator, self).__init__(*args, **kwargs)
 
@@ -337,6 +914,12 @@ class FileDownloadOperator(BaseOperator):
 
         self.dest_path = dest_path
 
+        if skip_unchanged and not marker_path:
+            raise AirflowException(
+                "A marker_path is required to skip unchanged files.")
+        self.skip_unchanged = skip_unchanged
+        self.marker_path = marker_path
+
     def execute(self, context):
         if not self.dest_path:
             self.create_temp_dest()
@@ -347,20 +930,165 @@ class FileDownloadOperator(BaseOperator):
 
     def create_temp_dest(self):
         try:
-            dest = mkstemp()
-            self.dest_path = dest.name
-            dest.close()
-        except e:
+            fd, self.dest_path = mkstemp()
+            os.close(fd)
+        except OSError as e:
             raise AirflowException("Failed to create temporary file for download: {}".format(e))
         else:
             logging.info("Created a temporary file for download at {}".format(self.dest_path))
 
     def download_source(self):
+        if self.skip_unchanged:
+            signature = source_signature(self.source_hook, self.source_path)
+            if signature == read_marker(self.marker_path):
+                raise AirflowSkipException(
+                    "File {} has not changed since it was last processed."
+                    .format(self.source_path))
+
         logging.info("Downloading file {} from {} source {} to local file {}."
             .format(self.source_path, self.source_type, self.source_conn_id, self.dest_path))
-        self.SourceHook(self.source_conn_id).download(self.source_path, self.dest_path)
+        self.source_hook.download(self.source_path, self.dest_path)
+
+        if self.skip_unchanged:
+            stage_marker(self.marker_path, signature)
+
+class MultiFileDownloadOperator(BaseOperator):
+    """
+    Downloads several files from a connection at once. The local paths of
+    the downloaded files are returned together as a single xcom variable, a
+    dictionary keyed by the names in `transfers`.
+
+    :param transfers: The files to download, as a dictionary mapping a name
+                      for each file to either its source path, or a
+                      (source path, dest path) pair. Files without a dest
+                      path are downloaded to temporary files.
+    :type transfers: dict
+    :param max_workers: The number of files to download concurrently. Defaults
+                        to the number of transfers.
+    :type max_workers: int
+    :param skip_unchanged: Whether to leave out files that have the same size
+                           and modification time as when they were last
+                           processed. Files that are left out are missing
+                           from the returned dictionary, and the task is
+                           skipped if none of the files have changed.
+    :type skip_unchanged: bool
+    :param marker_paths: Where to record the size and modification time of
+                         each file, as a dictionary keyed by the names in
+                         `transfers`. Required when `skip_unchanged` is set;
+                         see `FileDownloadOperator`.
+    :type marker_paths: dict
+    """
+    template_fields = ('transfers','marker_paths',)
+    template_ext = ()
+    ui_color = '#ffcc44'
+
+    @apply_defaults
+    def __init__(self,
+                 source_type,
+                 transfers,
+                 source_conn_id=None,
+                 max_workers=None,
+                 skip_unchanged=False,
+                 marker_paths=None,
+                 *args, **kwargs):
+        super(MultiFileDownloadOperator, self).__init__(*args, **kwargs)
+
+        self.source_type = source_type
+        self.source_conn_id = source_conn_id
+        self.transfers = transfers
+        self.max_workers = max_workers
+
+        if skip_unchanged and set(marker_paths or {}) != set(transfers):
+            raise AirflowException(
+                "A marker path is required for each file to skip unchanged files.")
+        self.skip_unchanged = skip_unchanged
+        self.marker_paths = marker_paths
+
+        self.SourceHook = CommonFileHook.by_type(source_type)
+
+    def execute(self, context):
+        transfers = {}
+        for name, transfer in self.transfers.items():
+            if isinstance(transfer, basestring):
+                transfers[name] = (transfer, None)
+            else:
+                transfers[name] = tuple(transfer)
+
+        if not transfers:
+            logging.info("No files to download.")
+            return {}
+
+        # Each worker gets its own hook (and so its own connection, borrowed
+        # from the pool where the hook supports it), since a single SFTP
+        # session can't safely be shared between threads.
+        max_workers = self.max_workers or len(transfers)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                name: executor.submit(self.download_source, source_path, dest_path,
+                                      self.get_marker_path(name))
+                for name, (source_path, dest_path) in transfers.items()
+            }
+
+        failures = []
+        for name, future in sorted(futures.items()):
+            error = future.exception()
+            if error is not None:
+                logging.error("Failed to download {} ({}): {}"
+                    .format(name, transfers[name][0], error))
+                failures.append('{} ({}): {}'.format(name, transfers[name][0], error))
+        if failures:
+            raise AirflowException("Failed to download: " + '; '.join(failures))
+
+        downloads = {name: future.result() for name, future in futures.items()
+                     if future.result() is not None}
+        if not downloads:
+            raise AirflowSkipException("None of the files have changed since "
+                                       "they were last processed.")
+
+        # Return the destination paths as an xcom variable
+        return downloads
+
+    def get_marker_path(self, name):
+        if self.skip_unchanged:
+            return self.marker_paths[name]
+        return None
+
+    def create_temp_dest(self):
+        try:
+            fd, dest_path = mkstemp()
+            os.close(fd)
+        except OSError as e:
+            raise AirflowException("Failed to create temporary file for download: {}".format(e))
+        else:
+            logging.info("Created a temporary file for download at {}".format(dest_path))
+        return dest_path
+
+    def download_source(self, source_path, dest_path, marker_path=None):
+        """
+        Download a single file, and return its local path, or None if the file
+        was left out because it hasn't changed.
+        """
+        source_hook = self.SourceHook(self.source_conn_id)
+
+        if marker_path:
+            signature = source_signature(source_hook, source_path)
+            if signature == read_marker(marker_path):
+                logging.info("File {} has not changed since it was last processed."
+                    .format(source_path))
+                return None
+
+        if dest_path is None:
+            dest_path = self.create_temp_dest()
+
+        logging.info("Downloading file {} from {} source {} to local file {}."
+            .format(source_path, self.source_type, self.source_conn_id, dest_path))
+        source_hook.download(source_path, dest_path)
+
+        if marker_path:
+            stage_marker(marker_path, signature)
+        return dest_path
 
-class FolderDownloadOperator(BaseOperator):
+class FolderDownloadOperator(SourceHookMixin, BaseOperator):
     """
     Downloads a folder from a connection.
     """
@@ -395,10 +1123,8 @@ class FolderDownloadOperator(BaseOperator):
 
     def create_temp_dest(self):
         try:
-            dest = mkstemp()
-            self.dest_path = dest.name
-            dest.close()
-        except e:
+            self.dest_path = mkdtemp()
+        except OSError as e:
             raise AirflowException("Failed to create temporary folder for download: {}".format(e))
         else:
             logging.info("Created a temporary folder for download at {}".format(self.dest_path))
@@ -406,9 +1132,9 @@ class FolderDownloadOperator(BaseOperator):
     def download_source(self):
         logging.info("Downloading folder {} from {} source {} to local folder {}."
             .format(self.source_path, self.source_type, self.source_conn_id, self.dest_path))
-        self.SourceHook(self.source_conn_id).download_folder(self.source_path, self.dest_path)
+        self.source_hook.download_folder(self.source_path, self.dest_path)
 
-class FileTransferOperator(BaseOperator):
+class FileTransferOperator(SourceHookMixin, BaseOperator):
     """
     Transfers a file from one connection to another.
 
@@ -457,17 +1183,22 @@ class FileTransferOperator(BaseOperator):
     def open_source(self):
         logging.info("Opening file {} on {} source {}."
             .format(self.source_path, self.source_type, self.source_conn_id))
-        return self.SourceHook(self.source_conn_id).open(self.source_path, 'rb')
+        return self.source_hook.open(self.source_path, 'rb')
 
     def open_dest(self):
         logging.info("Opening file {} on {} dest {}."
             .format(self.dest_path, self.dest_type, self.dest_conn_id))
-        return self.DestHook(self.dest_conn_id).open(self.dest_path, 'w')
+        return self.dest_hook.open(self.dest_path, 'wb')
+
+    @property
+    def dest_hook(self):
+        if getattr(self, '_dest_hook', None) is None:
+            self._dest_hook = self.DestHook(self.dest_conn_id)
+        return self._dest_hook
 
     def transfer(self, source, dest):
         logging.info("Transferring data from source to destination.")
-        for chunk in source:
-            dest.write(chunk)
+        copyfileobj(source, dest, COPY_BUFSIZE)
 
 class FileTransformOperator (FileTransferOperator):
     """
@@ -496,10 +1227,33 @@ class FileTransformOperator (FileTransferOperator):
         self.use_stdout = use_stdout
 
     def transfer(self, source, dest):
-        # Dump the source to a temporary file
+        # If the script reads and writes standard streams, pipe the data
+        # straight through it.
+        if self.use_stdin and self.use_stdout:
+            if is_os_file(source) and is_os_file(dest):
+                # Both ends are real files (e.g. on the local file system), so
+                # let the script read and write them itself.
+                logging.info('Running the transformation script command: ' +
+                             self.transform_script)
+                self.sp = subprocess.run([self.transform_script],
+                                         stdin=source,
+                                         stdout=dest,
+                                         stderr=subprocess.PIPE)
+                if self.sp.returncode != 0:
+                    raise AirflowException("Transform script failed " +
+                                           self.sp.stderr.decode('utf-8', 'replace'))
+            else:
+                pipe_through(
+                    [self.transform_script],
+                    lambda stdin: copyfileobj(source, stdin, COPY_BUFSIZE),
+                    lambda stdout: copyfileobj(stdout, dest, COPY_BUFSIZE))
+            logging.info("Transform script successful.")
+            return
+
+        # Otherwise, dump the source to a temporary file
         with NamedTemporaryFile() as f_source:
             logging.info('Dumping source data to a file: ' + f_source.name)
-            f_source.write(source.read())
+            copyfileobj(source, f_source, COPY_BUFSIZE)
             f_source.seek(0)
 
             # Open a temporary file to receive the output from the
@@ -510,8 +1264,7 @@ class FileTransformOperator (FileTransferOperator):
 
                 # Write the transformed data to the destination
                 logging.info('Transferring transformed data from to destination.')
-                for chunk in f_dest:
-                    dest.write(chunk)
+                copyfileobj(f_dest, dest, COPY_BUFSIZE)
 
     def transform(self, f_source, f_dest):
         script_args = [self.transform_script]
@@ -536,7 +1289,134 @@ class FileTransformOperator (FileTransferOperator):
                          "Output temporarily located at {0}"
                          "".format(f_dest.name))
 
-class FileAvailabilitySensor (BaseSensorOperator):
+class StreamingETLOperator (SourceHookMixin, BaseOperator):
+    """
+    Streams a file from a connection through a transformation script and
+    straight into a Postgres table, without staging anything on disk.
+
+    :param source_conn_id: The connection to run the operator against.
+    :type source_conn_id: string
+    :param source_path: The path to the file on the server
+    :type source_path: string
+    :param transform_script: The script that transforms the file into a CSV,
+                             reading from stdin and writing to stdout
+    :type transform_script: string
+    :param db_conn_id: The database connection to load into.
+    :type db_conn_id: string
+    :param db_table_name: The name of the table to load into.
+    :type db_table_name: string
+    :param truncate: Whether the table should be truncated before inserting.
+    :type truncate: bool
+    :param skip_unchanged: Whether to skip the load (and, by default, the
+                           tasks downstream of it) when the source file has
+                           the same size and modification time as when it was
+                           last processed; see `FileDownloadOperator`.
+    :type skip_unchanged: bool
+    :param marker_path: Where to record the size and modification time of the
+                        source file. Required when `skip_unchanged` is set.
+    :type marker_path: string
+    """
+
+    template_fields = ('source_path','transform_script','db_table_name','marker_path',)
+    template_ext = ()
+    ui_color = '#88ccff'
+
+    @apply_defaults
+    def __init__(self,
+                 source_type,
+                 source_path,
+                 transform_script,
+                 db_conn_id,
+                 db_table_name,
+                 source_conn_id=None,
+                 truncate=True,
+                 skip_unchanged=False,
+                 marker_path=None,
+                 *args, **kwargs):
+        super(StreamingETLOperator, self).__init__(*args, **kwargs)
+
+        self.source_type = source_type
+        self.source_conn_id = source_conn_id
+        self.source_path = source_path
+
+        self.SourceHook = CommonFileHook.by_type(source_type)
+
+        self.transform_script = transform_script
+        self.db_conn_id = db_conn_id
+        self.db_table_name = db_table_name
+        self.truncate = truncate
+
+        if skip_unchanged and not marker_path:
+            raise AirflowException(
+                "A marker_path is required to skip unchanged files.")
+        self.skip_unchanged = skip_unchanged
+        self.marker_path = marker_path
+
+    def execute(self, context):
+        if self.skip_unchanged:
+            signature = source_signature(self.source_hook, self.source_path)
+            if signature == read_marker(self.marker_path):
+                raise AirflowSkipException(
+                    "File {} has not changed since it was last processed."
+                    .format(self.source_path))
+
+        # The load is only committed once the whole file has made it through
+        # the script.
+        with table_load(self.db_conn_id, self.db_table_name, self.truncate) as cursor:
+            logging.info("Streaming file {} from {} source {} through {}."
+                .format(self.source_path, self.source_type,
+                        self.source_conn_id, self.transform_script))
+            pipe_through(
+                [self.transform_script],
+                lambda stdin: self.source_hook.retrieve_file(self.source_path, stdin),
+                lambda stdout: copy_csv_into_table(cursor, self.db_table_name, stdout))
+
+        if self.skip_unchanged:
+            stage_marker(self.marker_path, signature)
+
+        logging.info("Done!")
+
+class PgCopyCSVOperator (BaseOperator):
+    """
+    Load a CSV file into a Postgres table using COPY, so that the CSV is
+    parsed by the database server rather than row by row in Python. The
+    columns to fill are taken from the CSV's header row.
+
+    :param db_conn_id: The connection to run the operator against.
+    :type db_conn_id: string
+    :param db_table_name: The name of the table to load into.
+    :type db_table_name: string
+    :param csv_path: The path to the file on the server
+    :type csv_path: string
+    :param truncate: Whether the table should be truncated before inserting.
+    :type truncate: bool
+    """
+
+    template_fields = ('db_table_name','csv_path',)
+    template_ext = ()
+    ui_color = '#88ccff'
+
+    @apply_defaults
+    def __init__(self,
+                 db_conn_id,
+                 db_table_name,
+                 csv_path,
+                 truncate=True,
+                 *args, **kwargs):
+        super(PgCopyCSVOperator, self).__init__(*args, **kwargs)
+        self.db_conn_id = db_conn_id
+        self.db_table_name = db_table_name
+        self.csv_path = csv_path
+        self.truncate = truncate
+
+    def execute(self, context):
+        with table_load(self.db_conn_id, self.db_table_name, self.truncate) as cursor:
+            with open(self.csv_path, 'rb') as csvfile:
+                copy_csv_into_table(cursor, self.db_table_name, csvfile)
+
+        logging.info("Done!")
+
+class FileAvailabilitySensor (SourceHookMixin, BaseSensorOperator):
     """
     Waits for a file to land in a connection.
     """
@@ -564,7 +1444,7 @@ class FileAvailabilitySensor (BaseSensorOperator):
     def check_source(self):
         logging.info("Checking existence of file {} on {} source {}."
             .format(self.source_path, self.source_type, self.source_conn_id))
-        if self.SourceHook(self.source_conn_id).file_exists(self.source_path):
+        if self.source_hook.file_exists(self.source_path):
             logging.info("File exist.")
             return True
         else:
@@ -578,13 +1458,46 @@ class FolderAvailabilitySensor (FileAvailabilitySensor):
     def check_source(self):
         logging.info("Checking existence of folder {} on {} source {}."
             .format(self.source_path, self.source_type, self.source_conn_id))
-        if self.SourceHook(self.source_conn_id).folder_exists(self.source_path):
+        if self.source_hook.folder_exists(self.source_path):
             logging.info("Folder does not exist.")
             return True
         else:
             logging.info("Folder exists.")
             return False
 
+class CommitDownloadMarkerOperator(BaseOperator):
+    """
+    Records a file fetched with `skip_unchanged` (by a `FileDownloadOperator`,
+    `MultiFileDownloadOperator` or `StreamingETLOperator`) as processed, by
+    moving its pending marker into place. Put it at the end of the branch, so
+    that it only runs once everything downstream of the fetch has succeeded.
+
+    :param marker_path: The marker path given to the fetching operator.
+    :type marker_path: string
+    """
+    template_fields = ('marker_path',)
+    template_ext = ()
+    ui_color = '#ffcc44'
+
+    @apply_defaults
+    def __init__(self,
+                 marker_path,
+                 *args, **kwargs):
+        super(CommitDownloadMarkerOperator, self).__init__(*args, **kwargs)
+        self.marker_path = marker_path
+
+    def execute(self, context):
+        pending_path = pending_marker_path(self.marker_path)
+        try:
+            os.replace(pending_path, self.marker_path)
+        except OSError as e:
+            raise AirflowException(
+                "Failed to commit the download marker {}: {}"
+                .format(pending_path, e))
+        logging.info("Recorded the processed file's size and modification "
+                     "time in {}".format(self.marker_path))
+
+
 class CleanupOperator(BaseOperator):
     """
     Recursively deletes a set of files or folders.
@@ -627,7 +1540,9 @@ class CleanupOperator(BaseOperator):
 
 class FileTransferPlugin(AirflowPlugin):
     name = "file_transfer_plugin"
-    operators = [CleanupOperator, FileDownloadOperator, FolderDownloadOperator,
-        FileTransferOperator, FileTransformOperator,
+    operators = [CleanupOperator, CommitDownloadMarkerOperator,
+        FileDownloadOperator, FolderDownloadOperator,
+        MultiFileDownloadOperator, FileTransferOperator, FileTransformOperator,
+        StreamingETLOperator, PgCopyCSVOperator,
         FileAvailabilitySensor, FolderAvailabilitySensor]
     hooks = [CommonFileHook, CommonFSHook, CommonFTPHook, CommonFTPSHook, CommonS3Hook]
@@ -21,6 +21,8 @@ fi
 if [ "$1" = "webserver" ]; then
   echo "Initialize database..."
   $CMD initdb
+  echo "Creating pools..."
+  $CMD pool -s opa_etl 5 "OPA ETL tables"
   exec $CMD webserver
 else
   exec $CMD "$@"